@@ -2,20 +2,23 @@
 from dataclasses import dataclass, field
 
 # Only keys in this list will be in the config. Casing must match dataclasses
-validKeys = ["mqtt", "address", "port", "prefix", "events", "detections", "images",
+validKeys = ["mqtt", "address", "port", "prefix", "events", "detections", "images", "imageFormat",
              "rtspSimpleServer", "apiHost", "apiPort",
              "homeAssistant", "discoveryEnabled", "discoveryPrefix", "entityPrefix",
              "interactions", "slots", "threshold", "minTime", "expireTime",
-             "cameras", "rtspUrl", "videoPath", "imageUrl", "refresh", "model", "username", "password", "rewindSec", "timelapseDir", "timelapseInterval", "publishImages", "maxNoFrameSec",
+             "cameras", "rtspUrl", "videoPath", "imageUrl", "refresh", "model", "username", "password", "rewindSec", "timelapseDir", "timelapseInterval", "publishImages", "maxNoFrameSec", "hwDecode",
              "models", "path", "width", "labels", "yoloVersion",
              "recordingManager", "mediaRoot", "makeSymlinks", "keepVideosDays",
-             "yolo", "device", "multiprocessing"]
+             "yolo", "device", "multiprocessing", "amp", "shareModel", "pinWorkers"]
 
 
 @dataclass
 class Yolo:
     device: str = "cpu"
     multiprocessing: bool = True
+    amp: bool = True
+    shareModel: bool = False
+    pinWorkers: bool = False
 
 
 @dataclass
@@ -26,6 +29,7 @@ class Mqtt:
     events: str = "events"
     detections: str = "detections"
     images: str = "images"
+    imageFormat: str = "jpg"
 
 
 @dataclass
@@ -70,6 +74,7 @@ class Camera:
     timelapseInterval: int = 0
     publishImages: bool = False
     maxNoFrameSec: int = 30
+    hwDecode: bool = True
 
 
 @dataclass
@@ -110,6 +115,11 @@ class Config:
         cfg = config.get("mqtt", {})
         self._mqtt: Mqtt = Mqtt(**Config.validKeys(cfg))
         self._mqtt.prefix = self._mqtt.prefix.rstrip('/')
+        self._mqtt.imageFormat = str(self._mqtt.imageFormat).lower()
+        if self._mqtt.imageFormat == "jpeg":
+            self._mqtt.imageFormat = "jpg"
+        if self._mqtt.imageFormat not in ("jpg", "png"):
+            raise Exception(f"Unsupported mqtt imageFormat [{self._mqtt.imageFormat}], expected jpg or png")
 
         cfg = config.get("yolo", {})
         self._yolo: Yolo = Yolo(**Config.validKeys(cfg))
@@ -17,9 +17,11 @@ logger = logging.getLogger("rtspSource")
 
 class RtspSource(Source):
 
-    def __init__(self, name: str, rtspUrl: str, rtspApi: RtspSimpleServer = None, rewindBufSec: int = 0):
-        ''' RtspSimpleServer will be configured to host proxy stream for rtspUrl '''
+    def __init__(self, name: str, rtspUrl: str, rtspApi: RtspSimpleServer = None, rewindBufSec: int = 0, hwDecode: bool = True):
+        ''' RtspSimpleServer will be configured to host proxy stream for rtspUrl.
+            If hwDecode is set the stream is decoded on hardware when available '''
         self._name = name
+        self._hwDecode: bool = hwDecode
 
         self._rtspUrl = rtspUrl
         self._proxyRtspUrl = None
@@ -47,7 +49,10 @@ class RtspSource(Source):
 
     def _getCap(self) -> cv2.VideoCapture:
         ''' Returns CV2 video capture object for RTSP stream '''
-        return cv2.VideoCapture(self._proxyRtspUrl if self._proxyRtspUrl else self._rtspUrl, cv2.CAP_FFMPEG)
+        accel = cv2.VIDEO_ACCELERATION_ANY if self._hwDecode else cv2.VIDEO_ACCELERATION_NONE
+        cap = cv2.VideoCapture(self._proxyRtspUrl if self._proxyRtspUrl else self._rtspUrl, cv2.CAP_FFMPEG,
+                               [cv2.CAP_PROP_HW_ACCELERATION, accel])
+        return cap
 
     def _restartThread(self):
         if self._thread:
@@ -82,6 +87,8 @@ class RtspSource(Source):
         return None
 
     def _captureThread(self):
+        ''' Grabs every frame as it arrives so the stream never backs up. getNextFrame only decodes the latest
+            grabbed frame, this loop rather than any capture buffer setting is what keeps frames fresh '''
         logger.info(f"RTSP capture thread started for {self._name}")
         minRetryTime = 0.05
         maxRetryTime = 30
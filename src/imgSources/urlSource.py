@@ -17,6 +17,8 @@ class UrlSource(Source):
         if user:
             base64String = base64.b64encode(bytes(f"{user}:{password}", encoding='utf8'))
             self._request.add_header("Authorization", f"Basic {base64String.decode()}")
+        # Build the SSL context and opener once rather than for every frame
+        self._opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl._create_unverified_context()))
 
     def __repr__(self):
         return f"UrlSource [{self._url}]"
@@ -25,6 +27,6 @@ class UrlSource(Source):
         return self._downloadImage()
 
     def _downloadImage(self):
-        req = urllib.request.urlopen(self._request, context=ssl._create_unverified_context())
-        buffer = np.array(bytearray(req.read()), dtype=np.uint8)
+        with self._opener.open(self._request) as req:
+            buffer = np.frombuffer(req.read(), dtype=np.uint8)
         return cv2.imdecode(buffer, flags=cv2.IMREAD_COLOR)
@@ -12,11 +12,12 @@ from . source import Source
 
 class VideoSource(Source):
 
-    def __init__(self, paths: list[str]):
+    def __init__(self, paths: list[str], hwDecode: bool = True):
         if isinstance(paths, str):
             paths = [paths]
 
         self._paths: list[str] = paths
+        self._hwDecode: bool = hwDecode
         self._iter: Iterator = iter(self._paths)
         self._vidPath: str = None
         self._vid: cv2.VideoCapture = None
@@ -34,7 +35,8 @@ class VideoSource(Source):
         if not self._vidPath:
             self._iter = iter(self._paths)
             self._vidPath = next(self._iter)
-        self._vid = cv2.VideoCapture(self._vidPath)
+        accel = cv2.VIDEO_ACCELERATION_ANY if self._hwDecode else cv2.VIDEO_ACCELERATION_NONE
+        self._vid = cv2.VideoCapture(self._vidPath, cv2.CAP_ANY, [cv2.CAP_PROP_HW_ACCELERATION, accel])
 
     def getNextFrame(self) -> np.array:
         ret, frame = self._vid.read()
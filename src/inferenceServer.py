@@ -0,0 +1,181 @@
+''' Class to share a single YOLO model between multiple Watchers '''
+from concurrent.futures import Future
+import contextlib
+import functools
+import itertools
+from queue import Queue, Empty
+from threading import Thread, Event
+import logging
+import sys
+import cv2
+import numpy as np
+import torch
+
+from trackerTools.yoloInference import YoloInference
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger("InferenceServer")
+
+
+def _fitToModel(img: np.array, size: int) -> np.array:
+    ''' Shrinks img so its longest side is size. The model scales it to that size anyway and its results
+        are relative to the image, so shrinking first only saves work for everything that follows '''
+    height, width = img.shape[:2]
+    scale = size / max(height, width)
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _torchDevice(device: str) -> torch.device:
+    ''' Parses a YOLO device setting into a torch device. YOLO also accepts bare CUDA indices such as
+        "0" or "0,1", those map to the first listed GPU. Returns None if the setting can't be parsed '''
+    device = str(device).strip().lower()
+    index = device.split(",")[0].strip()
+    if index.isdigit():
+        device = f"cuda:{index}"
+    try:
+        return torch.device(device)
+    except RuntimeError:
+        return None
+
+
+class InferenceServer:
+    def __init__(self, model: YoloInference, inputSize: int = 640, warmupRuns: int = 2,
+                 amp: bool = False, device: str = "cpu"):
+        ''' Frames submitted from any thread are queued and run one at a time through the shared model
+            on the server thread, so the model is only loaded once however many Watchers use it.
+            YoloInference only takes a single image, so frames are not batched into one forward pass.
+            Frames are shrunk to the model's inputSize on the submitting thread.
+            The model is first warmed up with warmupRuns blank inputSize images.
+            device is the torch device the model was loaded on. On a CUDA device the model runs on its own
+            stream rather than the default stream, and if amp is set under autocast (mixed precision) '''
+        self._model: YoloInference = model
+        torchDevice = _torchDevice(device)
+        if torchDevice is None:
+            logger.warning(f"Unrecognized device [{device}], inference runs without a dedicated CUDA stream or amp")
+        useCuda: bool = torchDevice is not None and torchDevice.type == "cuda" and torch.cuda.is_available()
+        self._amp: bool = amp and useCuda
+        self._stream = torch.cuda.Stream(device=torchDevice) if useCuda else None
+        self._inputSize: int = inputSize
+        self._warmupRuns: int = warmupRuns
+        self._queue: Queue = Queue()
+        self._stopEvent: Event = Event()
+        self._thread: Thread = Thread(target=self._serverThread, name="InferenceServerThread", daemon=True)
+        self._thread.start()
+
+    def __del__(self):
+        self.stop()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def submit(self, img: np.array) -> Future:
+        ''' Queue an image for inference. The returned future resolves to the model's results for img '''
+        future = Future()
+        self._queue.put((_fitToModel(img, self._inputSize), future))
+        return future
+
+    def serveRemote(self, requestQueue: Queue, replyQueues: dict[str, Queue]):
+        ''' Serves InferenceClients in other processes. Requests are read from requestQueue and each
+            result is put on the reply queue of the client that sent it '''
+        thread = Thread(target=self._remoteThread, args=(requestQueue, replyQueues),
+                        name="InferenceServerRemoteThread", daemon=True)
+        thread.start()
+
+    def _remoteThread(self, requestQueue: Queue, replyQueues: dict[str, Queue]):
+        while not self._stopEvent.is_set():
+            try:
+                clientId, reqId, img = requestQueue.get(timeout=0.1)
+            except Empty:
+                continue
+            future = self.submit(img)
+            future.add_done_callback(functools.partial(InferenceServer._reply, replyQueues[clientId], reqId))
+
+    @staticmethod
+    def _reply(replyQueue: Queue, reqId: int, future: Future):
+        error = future.exception()
+        if error is not None:
+            # Send the message rather than the exception, which may not survive pickling
+            replyQueue.put((reqId, None, str(error)))
+        else:
+            replyQueue.put((reqId, future.result(), None))
+
+    def _warmup(self):
+        ''' Runs blank images through the model so one-time setup isn't paid for by the first real frame '''
+        blank = np.zeros((self._inputSize, self._inputSize, 3), dtype=np.uint8)
+        for _ in range(self._warmupRuns):
+            try:
+                self._runInference(blank)
+            except Exception as e:
+                logger.warning(f"Model warmup failed: {e}")
+                return
+
+    def _serverThread(self):
+        self._warmup()
+        logger.info("Inference server started")
+        while not self._stopEvent.is_set():
+            try:
+                img, future = self._queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._runInference(img))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _runInference(self, img: np.array) -> list:
+        # Autocast and the current stream are thread local, so they must be entered on the server thread that runs the model
+        # Autocast and the stream are only entered when used, even disabled they touch CUDA on builds without it
+        autocast = torch.autocast(device_type="cuda") if self._amp else contextlib.nullcontext()
+        stream = torch.cuda.stream(self._stream) if self._stream is not None else contextlib.nullcontext()
+        with stream, autocast:
+            return self._model.runInference(img=img)
+
+
+class InferenceClient:
+    def __init__(self, requestQueue: Queue, replyQueue: Queue, clientId: str, inputSize: int = 640):
+        ''' Submits frames to an InferenceServer in another process, see InferenceServer.serveRemote.
+            Frames are shrunk to the model's inputSize before being sent.
+            Only the queues are passed between processes, the reply thread starts on first submit '''
+        self._requestQueue: Queue = requestQueue
+        self._replyQueue: Queue = replyQueue
+        self._clientId: str = clientId
+        self._inputSize: int = inputSize
+        self._reset()
+
+    def __getstate__(self):
+        return (self._requestQueue, self._replyQueue, self._clientId, self._inputSize)
+
+    def __setstate__(self, state):
+        self._requestQueue, self._replyQueue, self._clientId, self._inputSize = state
+        self._reset()
+
+    def _reset(self):
+        self._pending: dict[int, Future] = {}
+        self._reqIds = itertools.count()
+        self._thread: Thread = None
+
+    def submit(self, img: np.array) -> Future:
+        ''' Queue an image for inference. The returned future resolves to the model's results for img '''
+        if self._thread is None:
+            self._thread = Thread(target=self._replyThread, name=f"InferenceClientThread_{self._clientId}", daemon=True)
+            self._thread.start()
+        future = Future()
+        reqId = next(self._reqIds)
+        self._pending[reqId] = future
+        self._requestQueue.put((self._clientId, reqId, _fitToModel(img, self._inputSize)))
+        return future
+
+    def _replyThread(self):
+        while True:
+            reqId, result, error = self._replyQueue.get()
+            future = self._pending.pop(reqId, None)
+            if future is None or not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(Exception(f"Remote inference failed: {error}"))
+            else:
+                future.set_result(result)
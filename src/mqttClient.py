@@ -54,8 +54,10 @@ class MqttClient:
         if absoluteTopic:
             publish_topic = topic
         else:
-            publish_topic = "{}/{}".format(self._prefix, topic)
-        logger.debug(f"Publishing {publish_topic} value of {value if isinstance(value, str) else 'non-string type'}")
+            publish_topic = self._prefix + "/" + topic
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Publishing {publish_topic} value of {value if isinstance(value, str) else 'non-string type'}")
+        # QoS 0 publishes only queue the message for paho's network thread, so this never waits on the broker
         self._mqtt.publish(publish_topic, value, retain=retain)
 
     def subscribe(self, topic: str, callback: Callable[[str], None]):
@@ -5,6 +5,8 @@ import copy
 
 
 class ValueStatTracker:
+    __slots__ = ("_lastValue", "_sum", "_sum_sq", "_count", "_min", "_max", "_avg")
+
     def __init__(self, value: float = None):
         self._lastValue: float = 0.0
         self._sum: float = 0.0
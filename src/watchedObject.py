@@ -18,6 +18,7 @@ class WatchedObject:
 
     @dataclass
     class Detection:
+        __slots__ = ("label", "conf", "bbox")
         label: str
         conf: float
         bbox: BBox
@@ -33,6 +34,7 @@ class WatchedObject:
         self._framesSeen: int = 0
         self._framesSinceSeen: int = 0
         self._confDict: dict[str, WatchedObject._ConfDictEntry] = {}
+        self._confSum: float = 0.0  # Running total of every detection confidence across all labels
         self._bestLabel: str = ""
         self._bestConf: float = 0.0
         self._lastBbox: BBox = BBox((0, 0, 0, 0))
@@ -92,6 +94,7 @@ class WatchedObject:
             self.updateBbox(detection.bbox)
 
             detectionEntry.tracker.addValue(detection.conf)
+            self._confSum += detection.conf
             detectionEntry.bbox = detection.bbox.copy()
             self._confDict[detection.label] = detectionEntry
             self._recalculateBest()
@@ -102,23 +105,16 @@ class WatchedObject:
 
     def _recalculateBest(self):
         ''' Recalculate the best label for this object '''
-        bestConf = 0.0
-        bestLabel = None
-        bestTracker = None
-
-        # Determine confidence this is the best label among tracked labels
-        meanConfSum = sum([entry.tracker.avg*entry.tracker.n for entry in self._confDict.values()])
-        for key, entry in self._confDict.items():
-            entry.conf = entry.tracker.sum / meanConfSum
-            if entry.conf > bestConf:
-                bestConf = entry.conf
-                bestLabel = key
-                bestTracker = entry.tracker
+        # Determine confidence this is the best label among tracked labels. Each label's
+        # confidence is its share of all confidence seen, so the best label has the largest sum
+        for entry in self._confDict.values():
+            entry.conf = entry.tracker.sum / self._confSum
+        bestLabel, bestEntry = max(self._confDict.items(), key=lambda item: item[1].tracker.sum)
 
         # Now get overall confidence by multiplying the confidence that this
         # is the best label by the confidence of that label
         self._bestLabel = bestLabel
-        self._bestConf = bestTracker.avg * bestConf
+        self._bestConf = bestEntry.tracker.avg * bestEntry.conf
 
     def labelConf(self, label) -> float:
         ''' Check confidence of a given label '''
@@ -1,22 +1,22 @@
 ''' Class to watch for objects in an image stream '''
-
-from dataclasses import dataclass
-from threading import Event
+from __future__ import annotations
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from queue import Queue, Empty, Full
+from threading import Event, Thread
 import cv2
-import datetime
 import os
 import logging
 import sys
 import numpy as np
 import time
 from signalslot import Signal
-from PIL import Image
 
-from trackerTools.yoloInference import YoloInference
 from trackerTools.bbox import BBox
 from trackerTools.bboxTracker import BBoxTracker
 from trackerTools.objectTracker import ObjectTracker
 from . imgSources.source import Source
+from . inferenceServer import InferenceServer
 from . valueStatTracker import ValueStatTracker
 from . watchedObject import WatchedObject
 
@@ -29,6 +29,18 @@ NEW_OBJ_MIN_FRAME_CNT = 5  # How many frames must a new object be present in bef
 BBOX_TRACKER_MAX_DIST_THRESH = 0.5  # Percent of image a box can move and still be matched
 MAX_DETECT_INTERVAL = 10  # Maximum amount of frames without full detection
 MIN_CONF_THRESH = 0.1  # Minimum confidence threshold for display
+SAME_BOX_IOU_THRESH = 0.7  # Detections overlapping by more than this are merged as the same object
+THREAD_JOIN_TIMEOUT = 5  # Seconds to wait for the render thread to finish when stopping
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX  # Font used for all labels drawn on images
+STATIC_FRAME_THUMB_SIZE = (64, 64)  # Size of the grayscale thumbnails compared to detect an unchanged scene
+STATIC_FRAME_BLOCKS = (8, 8)  # Thumbnail differences are averaged per block, so a change confined to one block isn't diluted
+STATIC_FRAME_DIFF_THRESH = 4  # Largest mean block pixel difference below which a scheduled inference is skipped
+MAX_STATIC_SKIPS = 5  # Scheduled inferences skipped in a row on an unchanged scene before one is run anyway
+
+# Tracker colors, brightening green as a new object ages and fading red as a lost object goes missing
+NEW_OBJ_COLORS = [(0, int(255 * age / NEW_OBJ_MIN_FRAME_CNT), 0) for age in range(NEW_OBJ_MIN_FRAME_CNT)]
+LOST_OBJ_COLORS = [(0, 0, int(255 * (LOST_OBJ_REMOVE_FRAME_CNT - missing) / LOST_OBJ_REMOVE_FRAME_CNT))
+                   for missing in range(LOST_OBJ_REMOVE_FRAME_CNT + 1)]
 
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger("Watcher")
@@ -36,12 +48,17 @@ logger = logging.getLogger("Watcher")
 
 class Watcher:
     @dataclass
-    class _DetectionInfo:
-        detection: WatchedObject.Detection
-
-    def __init__(self, source: Source, model: YoloInference, refreshDelay: float = 1.0, userData=None, timelapseDir: str = None, timelapseInterval: int = -1, debug: bool = False, maxNoFrameSec: int = 30):
+    class _Overlay:
+        ''' A box and its labels to draw, captured on the tracking thread for the render thread '''
+        bbox: BBox
+        labels: list[tuple[str, float]] = field(default_factory=list)  # (text, font size) for each line
+        color: tuple[int, int, int] = (255, 255, 255)
+        thickness: int = 1
+        align: int = 0
+
+    def __init__(self, source: Source, server: InferenceServer, refreshDelay: float = 1.0, userData=None, timelapseDir: str = None, timelapseInterval: int = -1, debug: bool = False, maxNoFrameSec: int = 30):
         self._source: Source = source
-        self._model: YoloInference = model
+        self._server: InferenceServer = server
         self._delay: float = refreshDelay
         self._stopEvent: Event = Event()
         self._objTracker: ObjectTracker = ObjectTracker(distThresh=BBOX_TRACKER_MAX_DIST_THRESH)
@@ -68,6 +85,8 @@ class Watcher:
         return self._updatedObjSignal.connect(slot)
 
     def connectImageUpdatedSignal(self, slot):
+        ''' slot receives the rendered BGR image. The array is reused for the next render, so a slot
+            that keeps the image beyond the call must copy it '''
         return self._imgUpdatedSignal.connect(slot)
 
     def disconnectNewObjSignal(self, slot):
@@ -85,243 +104,451 @@ class Watcher:
     def run(self):
         logger.info(f"Starting Watcher with [{self._source}], refreshing every {self._delay} seconds")
 
-        if self._debug:
-            dbgWin = f"DebugWindow {self._source}"
-            cv2.namedWindow(dbgWin, flags=cv2.WINDOW_NORMAL)
-        else:
-            dbgWin = None
-
         runDetectCntdwn = 0
         frameCnt: int = 0
-        loopStart = time.time()
         fetchTimeStats: ValueStatTracker = ValueStatTracker()
         trackTimeStats: ValueStatTracker = ValueStatTracker()
         inferTimeStats: ValueStatTracker = ValueStatTracker()
         forceInference: bool = True  # First loop always runs inference
-        lastFrameTime = time.time()
-        lastTimelapse = time.time()
-        nextTimelapse = float("inf")
+        lastInferThumb: np.array = None  # Thumbnail of the last frame inference ran on
+        staticSkips: int = 0  # Scheduled inferences skipped in a row because the scene was unchanged
+        lastTimelapse: int = time.monotonic_ns()
+        nextTimelapse: float = float("inf")
         if self._timelapseDir is not None and self._timelapseInterval > 0:
             try:
-                os.makedirs(self._timelapseDir, mode=555, exist_ok=True)
-                nextTimelapse = lastTimelapse + self._timelapseInterval
+                os.makedirs(self._timelapseDir, mode=0o755, exist_ok=True)
+                nextTimelapse = lastTimelapse + int(self._timelapseInterval * 1e9)
             except Exception as e:
                 logger.error(f"Failed to initialize timelapses: {e}")
 
-        while True:
-            timeElapsed = time.time() - loopStart
-            if self._stopEvent.wait(timeout=max(0, self._delay - timeElapsed)):
-                break
-            loopStart = time.time()
-            try:
-                startTime = time.time()
-                img = self._source.getNextFrame()
-                lastFrameTime = time.time()
-                fetchTimeStats.addValue(lastFrameTime - startTime)
-            except Exception as e:
-                logger.error(f"Exception getting image for {self._source}: {str(e)}")
-                if time.time() - lastFrameTime > self._maxNoFrameInterval:
-                    logger.error(f"Timeout exceeded! It has been {time.time() - lastFrameTime} since last frame! Restarting source...")
-                    self._source.restart()
-                continue
+        # Fetch frames in the background so the next frame is decoded while this one is processed.
+        # Tracking and inference share the object tracker, so they stay together on this thread.
+        frameQueue: Queue = Queue(maxsize=1)
+        fetchThread: Thread = Thread(target=self._fetchThreadProc, args=(frameQueue, fetchTimeStats),
+                                     name=f"WatcherFetchThread_{self._source}", daemon=True)
+        fetchThread.start()
+
+        # Drawing, publishing and displaying images happens on a render thread
+        renderQueue: Queue = Queue(maxsize=2)
+        renderThread: Thread = Thread(target=self._renderThreadProc, args=(renderQueue,),
+                                      name=f"WatcherRenderThread_{self._source}", daemon=True)
+        renderThread.start()
+
+        # Bind hot attributes to locals for the frame loop
+        objTracker: ObjectTracker = self._objTracker
+        server: InferenceServer = self._server
+        metaCompare = Watcher._metaCompare
+        clock = time.monotonic_ns
+
+        try:
+            while True:
+                img = frameQueue.get()
+                if img is None:
+                    break
+                # Checked once per frame so debug-only strings are never formatted in production
+                debugLog: bool = logger.isEnabledFor(logging.DEBUG)
+                keepStats: bool = self._wantsStats()
+
+                # Submit inference as soon as the frame arrives so the model runs on the server thread
+                # while this thread does any other work for the frame
+                runInference: bool = forceInference or runDetectCntdwn <= 0
+                if runInference:
+                    # A scheduled inference on a scene that hasn't changed since the last one would only
+                    # find the same objects again, so just keep tracking them. Inference still runs after
+                    # MAX_STATIC_SKIPS skips in a row in case a change was too small to show up in the thumbnail
+                    thumb = Watcher._thumbnail(img)
+                    if not forceInference and lastInferThumb is not None and staticSkips < MAX_STATIC_SKIPS and \
+                            not Watcher._sceneChanged(thumb, lastInferThumb):
+                        runInference = False
+                        runDetectCntdwn = MAX_DETECT_INTERVAL
+                        staticSkips += 1
+                    else:
+                        lastInferThumb = thumb
+                        staticSkips = 0
+                if runInference:
+                    startTime = clock()
+                    logger.debug("Running inference")
+                    pendingRes: Future = server.submit(img)
+
+                if clock() > nextTimelapse:
+                    try:
+                        self.saveTimelapse(img)
+                        nextTimelapse = clock() + int(self._timelapseInterval * 1e9)
+                    except Exception as e:
+                        logger.error(f"Failed to save timelapse for {self._source}: {str(e)}")
+
+                # Just run object tracking if not scheduled to run inference
+                if not runInference:
+                    startTime = clock()
+                    trackedObjs, _, lostObjs, detectedKeys = objTracker.update(image=img)
+                    if keepStats:
+                        trackTimeStats.addValue((clock() - startTime) / 1e9)
+                    runDetectCntdwn -= 1
+                    # If an object was lost then run inference on the next frame. Running it on this
+                    # frame would mean tracking the same image a second time. The lost object itself is
+                    # still handled on this frame so its removal isn't delayed
+                    lostObjs = set(lostObjs)
+                    if len(lostObjs) > 0:
+                        forceInference = True
 
-            if time.time() > nextTimelapse:
-                try:
-                    self.saveTimelapse(img)
-                    nextTimelapse = time.time() + self._timelapseInterval
-                except Exception as e:
-                    logger.error(f"Failed to save timelapse for {self._source}: {str(e)}")
-
-
-            # Just run object tracking if not scheduled to run inference
-            runInference: bool = forceInference or runDetectCntdwn <= 0
-            if not runInference:
-                startTime = time.time()
-                trackedObjs, _, lostObjs, detectedKeys = self._objTracker.update(image=img)
-                trackTimeStats.addValue(time.time() - startTime)
-                runDetectCntdwn -= 1
-                # If an object was lost then run inference
-                if len(lostObjs) > 0:
-                    runInference = True
-                else:
-                    # If not going to run inference then be sure to update location of tracked objects.
+                    # Not running inference, so be sure to update location of tracked objects.
                     # TODO: Clean this up. It's a quick hack to just put this here
                     for key, obj in trackedObjs.items():
                         trackedObj: WatchedObject = obj.metadata.get(METAKEY_TRACKED_WATCHED_OBJ, None)
-                        if trackedObj.bbox != obj.bbox:
+                        if key in lostObjs:
+                            self._processLostObj(objTracker, key, trackedObj)
+                        elif trackedObj.bbox != obj.bbox:
                             trackedObj.updateBbox(obj.bbox)
                             self._updatedObjSignal.emit(obj=trackedObj, userData=self._userData)
 
-            # Run inference if required
-            yoloRes = []
-            if runInference:
-                forceInference = False
-                runDetectCntdwn = MAX_DETECT_INTERVAL
-
-                # Run the image through the model
-                startTime = time.time()
-                logger.debug("Running inference")
-                yoloRes = self._model.runInference(img=img)
-
-                # Now merge any duplicate boxes from the inference
-                detBboxes: list[BBox] = []
-                metadata: list[WatchedObject.Detection] = []
-                SAME_BOX_DIST_THRESH = 0.03
-                SAME_BOX_SIZE_THRESH = 0.9
-                for bbox, conf, objClass, label in yoloRes:
-                    detectInfo = Watcher._DetectionInfo(detection=WatchedObject.Detection(label, conf, bbox))
-
-                    # Check if this may be a second detection of the same object
-                    dupIdx = -1
-                    for idx, prevDet in enumerate(detBboxes):
-                        if detectInfo.detection.bbox.similar(prevDet, SAME_BOX_DIST_THRESH, SAME_BOX_SIZE_THRESH):
-                            dupIdx = idx
-                            break
-
-                    # Merge any duplicate boxes into one
-                    if dupIdx != -1:
-                        # Add this detection to the original detection list
-                        metadata[dupIdx][METAKEY_DETECTIONS].append(detectInfo)
-                    else:
-                        # Add new detection
-                        detBboxes.append(bbox)
-                        metadata.append({METAKEY_DETECTIONS: [detectInfo]})
-
-                def metaCompare(trackedInfo: tuple[BBox, dict], detectedInfo: tuple[BBox, dict]) -> float:
-                    ''' This function returns confidence that two objects are the same object.
-                        This will influence matching detected objects with already-tracked objects '''
-                    trackedBbox, trackedMeta = trackedInfo
-                    detectedBbox, detectMeta = detectedInfo
-                    assert(METAKEY_DETECTIONS in detectMeta)
-                    assert(METAKEY_TRACKED_WATCHED_OBJ in trackedMeta)
-
-                    newDetInfos: list[Watcher._DetectionInfo] = detectMeta[METAKEY_DETECTIONS]
-                    trackedObj: WatchedObject = trackedMeta[METAKEY_TRACKED_WATCHED_OBJ]
-
-                    bestLabelConf: float = 0.0
-                    for detInfo in newDetInfos:
-                        bestLabelConf = max(trackedObj.labelConf(detInfo.detection.label), bestLabelConf)
-
-                    if not trackedBbox.similar(detectedBbox):
-                        bestLabelConf *= 0.5
-                    return bestLabelConf
-
-                # Run the object tracker, updating it with the current inference detections
-                trackedObjs, newObjs, lostObjs, detectedKeys = self._objTracker.update(image=img, detections=detBboxes,
-                                                                                       metadata=metadata, metadataComp=metaCompare, mergeMetadata=True)
-
-                # Process each tracked item
-                for key, obj in trackedObjs.items():
-                    trackedObj: WatchedObject = obj.metadata.get(METAKEY_TRACKED_WATCHED_OBJ, None)
-
-                    # Pop any temporary detection info off that may be on the tracked object
-                    detBboxes: list[Watcher._DetectionInfo] = obj.metadata.pop(METAKEY_DETECTIONS, [])
-                    if len(detBboxes) > 0:
-                        # Update objTracker with the metadata from which we popped off the temporary detection info
-                        self._objTracker.updateBox(key, metadata=obj.metadata)
-
-                    if key in newObjs:
-                        assert(trackedObj is None)
-                        trackedObj: WatchedObject = WatchedObject(objId=key)
-                        for detectInfo in detBboxes:
-                            trackedObj.markSeen(detectInfo.detection, newFrame=False)
-                        forceInference = True
-                        obj.metadata[METAKEY_TRACKED_WATCHED_OBJ] = trackedObj
-                        self._objTracker.updateBox(key, metadata=obj.metadata)
-                    elif key in lostObjs:
-                        # If it was lost before reaching the minimum frame count then remove it
-                        if trackedObj.age < NEW_OBJ_MIN_FRAME_CNT:
-                            logger.debug(f"{trackedObj.label} lost before minimum frame count")
-                            self._objTracker.removeBox(key)
-                        else:
-                            trackedObj.markMissing()
-                            forceInference = True
-                            if trackedObj.framesSinceSeen > LOST_OBJ_REMOVE_FRAME_CNT:
-                                logger.debug(f"{trackedObj.label} lost for {trackedObj.framesSinceSeen}, removing")
-                                self._lostObjSignal.emit(obj=trackedObj, userData=self._userData)
-                                self._objTracker.removeBox(key)
-                    else:
-                        # A previously tracked object, ensure it isn't marked as lost and add any new detections
-                        for detectInfo in detBboxes:
-                            trackedObj.markSeen(detectInfo.detection, newFrame=False)
-                        trackedObj.markSeen()
-                        self._objTracker.updateBox(key, bbox=trackedObj.bbox)
-
-                        # Run inference every frame when there is a new object
-                        if trackedObj.age < NEW_OBJ_MIN_FRAME_CNT:
+                # Run inference if required
+                yoloRes = []
+                if runInference:
+                    forceInference = False
+                    runDetectCntdwn = MAX_DETECT_INTERVAL
+
+                    # Collect the model's results for the image
+                    yoloRes = pendingRes.result()
+
+                    # Split the results into parallel arrays so deduplication works on whole columns at once
+                    bboxes, boxes, confs, labels = Watcher._splitResults(yoloRes)
+
+                    # Now merge any duplicate boxes from the inference
+                    numGroups, groups = Watcher._groupDuplicates(Watcher._duplicateMatrix(boxes, SAME_BOX_IOU_THRESH))
+
+                    # The most confident box of a group represents it. Sorting by group then descending
+                    # confidence puts each group's best detection first in its run
+                    order = np.lexsort((-confs, groups))
+                    _, firstIdxs = np.unique(np.asarray(groups)[order], return_index=True)
+                    detBboxes: list[BBox] = [bboxes[idx] for idx in order[firstIdxs]]
+
+                    # Bucket every detection into its group
+                    metadata: list[dict] = [{METAKEY_DETECTIONS: []} for _ in range(numGroups)]
+                    for bbox, conf, label, group in zip(bboxes, confs.tolist(), labels, groups):
+                        metadata[group][METAKEY_DETECTIONS].append(WatchedObject.Detection(label, conf, bbox))
+
+                    # Run the object tracker, updating it with the current inference detections
+                    trackedObjs, newObjs, lostObjs, detectedKeys = objTracker.update(image=img, detections=detBboxes,
+                                                                                     metadata=metadata, metadataComp=metaCompare, mergeMetadata=True)
+                    # Every tracked object is checked against these, so make the membership tests hash lookups
+                    newObjs, lostObjs = set(newObjs), set(lostObjs)
+
+                    # Metadata changes are collected while processing and pushed to the tracker once per object
+                    pendingMeta: dict[int, dict] = {}
+
+                    # Process each tracked item
+                    for key, obj in trackedObjs.items():
+                        trackedObj: WatchedObject = obj.metadata.get(METAKEY_TRACKED_WATCHED_OBJ, None)
+
+                        # Pop any temporary detection info off that may be on the tracked object
+                        detections: list[WatchedObject.Detection] = obj.metadata.pop(METAKEY_DETECTIONS, [])
+                        if len(detections) > 0:
+                            # Update objTracker with the metadata from which we popped off the temporary detection info
+                            pendingMeta[key] = obj.metadata
+
+                        if key in newObjs:
+                            assert(trackedObj is None)
+                            trackedObj: WatchedObject = WatchedObject(objId=key)
+                            for detection in detections:
+                                trackedObj.markSeen(detection, newFrame=False)
                             forceInference = True
-                        elif trackedObj.age == NEW_OBJ_MIN_FRAME_CNT:
-                            self._newObjSignal.emit(obj=trackedObj, userData=self._userData)
+                            obj.metadata[METAKEY_TRACKED_WATCHED_OBJ] = trackedObj
+                            pendingMeta[key] = obj.metadata
+                        elif key in lostObjs:
+                            if trackedObj.age >= NEW_OBJ_MIN_FRAME_CNT:
+                                forceInference = True
+                            if self._processLostObj(objTracker, key, trackedObj):
+                                pendingMeta.pop(key, None)
                         else:
-                            self._updatedObjSignal.emit(obj=trackedObj, userData=self._userData)
+                            # A previously tracked object, ensure it isn't marked as lost and add any new detections
+                            for detection in detections:
+                                trackedObj.markSeen(detection, newFrame=False)
+                            trackedObj.markSeen()
+                            # Most objects are stable between frames, only push the box back if it moved
+                            if trackedObj.bbox != obj.bbox:
+                                objTracker.updateBox(key, bbox=trackedObj.bbox)
+
+                            # Run inference every frame when there is a new object
+                            if trackedObj.age < NEW_OBJ_MIN_FRAME_CNT:
+                                forceInference = True
+                            elif trackedObj.age == NEW_OBJ_MIN_FRAME_CNT:
+                                self._newObjSignal.emit(obj=trackedObj, userData=self._userData)
+                            else:
+                                self._updatedObjSignal.emit(obj=trackedObj, userData=self._userData)
+
+                        if debugLog:
+                            logger.debug(f"{key} - {obj.metadata}")
+
+                    for key, meta in pendingMeta.items():
+                        objTracker.updateBox(key, metadata=meta)
+
+                    if keepStats:
+                        inferTimeStats.addValue((clock() - startTime) / 1e9)
+
+                # Only publish if inference was ran and there is a listener for the image
+                should_publish_image = yoloRes and len(self._imgUpdatedSignal.slots) > 0
+
+                if self._debug or should_publish_image:
+                    # Capture what to draw now, the render thread draws it while the next frame is processed
+                    overlays: list[Watcher._Overlay] = [Watcher._Overlay(bbox=bbox, labels=[(f"{label}: {conf:0.2}", 0.4)],
+                                                                         color=(0, 255, 0), thickness=2, align=7)
+                                                        for bbox, conf, classIdx, label in yoloRes]
+                    for key, tracker in objTracker.getTrackedObjects().items():
+                        trackedObj: WatchedObject = tracker.metadata[METAKEY_TRACKED_WATCHED_OBJ]
+
+                        if trackedObj.conf >= MIN_CONF_THRESH:
+                            overlays.append(Watcher._trackerOverlay(tracker))
+                    dbgInfo = f"Fetch: {fetchTimeStats.lastValue:0.2}|{fetchTimeStats.avg:0.2}  Track: {trackTimeStats.lastValue:0.2}|{trackTimeStats.avg:0.2}  Infer: {inferTimeStats.lastValue:0.2}|{inferTimeStats.avg:0.2}"
+                    # If encoding/publishing has fallen behind, replace the stalest pending render instead of waiting on it
+                    Watcher._putLatest(renderQueue, (img, overlays, dbgInfo, bool(yoloRes)))
+
+                if debugLog:
+                    logger.debug(f"---End of frame {frameCnt} [{self._source}]---")
+                frameCnt += 1
+        finally:
+            # Stop both threads even if the loop raised, otherwise the fetch thread keeps decoding frames
+            # for nobody and the render thread waits forever for its stop signal
+            self._stopEvent.set()
+            # Replaces any pending render rather than blocking if the render thread isn't draining the queue
+            Watcher._putLatest(renderQueue, None)
+            fetchThread.join()
+            renderThread.join(timeout=THREAD_JOIN_TIMEOUT)
+        logger.info(f"!!!Exit frame capture loop for {self._source}!!!")
 
-                    logger.debug(f"{key} - {obj.metadata}")
+    def _fetchThreadProc(self, frameQueue: Queue, fetchTimeStats: ValueStatTracker):
+        ''' Fetches a frame every refresh period and hands it to run(). A None frame signals a stop '''
+        source: Source = self._source
+        stopEvent: Event = self._stopEvent
+        clock = time.monotonic_ns
+        delayNs: int = int(self._delay * 1e9)
+        deadline: int = clock()  # The first frame is fetched right away
+        lastFrameTime: int = deadline
+        while True:
+            if stopEvent.wait(timeout=max(0, deadline - clock()) / 1e9):
+                break
+            loopStart = clock()
+            # Fetches are due on a fixed cadence so wakeup latency doesn't accumulate. If a fetch
+            # ran over, the cadence restarts from now rather than bursting to catch up
+            deadline = max(deadline + delayNs, loopStart)
+            try:
+                img = source.getNextFrame()
+                if img is None:
+                    raise Exception("No frame returned")
+                lastFrameTime = clock()
+                if self._wantsStats():
+                    fetchTimeStats.addValue((lastFrameTime - loopStart) / 1e9)
+            except Exception as e:
+                logger.error(f"Exception getting image for {source}: {str(e)}")
+                noFrameTime = (clock() - lastFrameTime) / 1e9
+                if noFrameTime > self._maxNoFrameInterval:
+                    logger.error(f"Timeout exceeded! It has been {noFrameTime} since last frame! Restarting source...")
+                    source.restart()
+                continue
 
-                inferTimeStats.addValue(time.time() - startTime)
+            Watcher._putLatest(frameQueue, img)
+        Watcher._putLatest(frameQueue, None)
 
-            # Only publish if inference was ran and there is a listener for the image
-            should_publish_image = yoloRes and len(self._imgUpdatedSignal.slots) > 0
+    @staticmethod
+    def _thumbnail(img: np.array) -> np.array:
+        ''' Returns a small grayscale copy of img for cheaply comparing frames '''
+        return cv2.cvtColor(cv2.resize(img, STATIC_FRAME_THUMB_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
 
-            if self._debug or should_publish_image:
-                dbgImg = img.copy()
-                for bbox, conf, classIdx, label in yoloRes:
-                    Watcher.drawBboxOnImage(dbgImg, bbox, color=(0, 255, 0), thickness=2)
-                    Watcher.drawBboxLabel(dbgImg, bbox, f"{label}: {conf:0.2}", color=(0, 255, 0), align=7)
+    @staticmethod
+    def _sceneChanged(thumb: np.array, lastThumb: np.array) -> bool:
+        ''' True if any block of thumb differs from lastThumb by at least STATIC_FRAME_DIFF_THRESH on average '''
+        blockDiffs = cv2.resize(cv2.absdiff(thumb, lastThumb), STATIC_FRAME_BLOCKS, interpolation=cv2.INTER_AREA)
+        return blockDiffs.max() >= STATIC_FRAME_DIFF_THRESH
 
-                for key, tracker in self._objTracker.getTrackedObjects().items():
-                    trackedObj: WatchedObject = tracker.metadata[METAKEY_TRACKED_WATCHED_OBJ]
+    @staticmethod
+    def _metaCompare(trackedInfo: tuple[BBox, dict], detectedInfo: tuple[BBox, dict]) -> float:
+        ''' This function returns confidence that two objects are the same object.
+            This will influence matching detected objects with already-tracked objects '''
+        trackedBbox, trackedMeta = trackedInfo
+        detectedBbox, detectMeta = detectedInfo
+        assert(METAKEY_DETECTIONS in detectMeta)
+        assert(METAKEY_TRACKED_WATCHED_OBJ in trackedMeta)
+
+        newDetections: list[WatchedObject.Detection] = detectMeta[METAKEY_DETECTIONS]
+        trackedObj: WatchedObject = trackedMeta[METAKEY_TRACKED_WATCHED_OBJ]
+
+        bestLabelConf: float = 0.0
+        for detection in newDetections:
+            bestLabelConf = max(trackedObj.labelConf(detection.label), bestLabelConf)
 
-                    if trackedObj.conf >= MIN_CONF_THRESH:
-                        Watcher.drawTrackerOnImage(dbgImg, tracker)
-                dbgInfo = f"Fetch: {fetchTimeStats.lastValue:0.2}|{fetchTimeStats.avg:0.2}  Track: {trackTimeStats.lastValue:0.2}|{trackTimeStats.avg:0.2}  Infer: {inferTimeStats.lastValue:0.2}|{inferTimeStats.avg:0.2}"
-                cv2.putText(dbgImg, dbgInfo, (0, 32), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1, cv2.LINE_AA)
+        if not trackedBbox.similar(detectedBbox):
+            bestLabelConf *= 0.5
+        return bestLabelConf
+
+    @staticmethod
+    def _splitResults(yoloRes: list[tuple[BBox, float, int, str]]) -> tuple[list[BBox], np.array, np.array, list[str]]:
+        ''' Splits inference results into their bboxes, an (N,4) array of relative x1,y1,x2,y2 boxes, an (N,)
+            array of confidences and their labels. Labels are interned so the per-label lookups done by
+            metaCompare for every tracked/detected pair compare by identity '''
+        if len(yoloRes) == 0:
+            return [], np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float64), []
+        bboxes, confs, _, labels = zip(*yoloRes)
+        boxes = np.array([bbox.asRX1Y1WH() for bbox in bboxes], dtype=np.float32)
+        boxes[:, 2:] += boxes[:, :2]
+        return list(bboxes), boxes, np.array(confs, dtype=np.float64), [sys.intern(label) for label in labels]
 
-                if yoloRes:
-                    pilImg: Image = Image.fromarray(cv2.cvtColor(dbgImg, cv2.COLOR_BGR2RGB))
-                    self._imgUpdatedSignal.emit(image=pilImg, userData=self._userData)
+    @staticmethod
+    def _duplicateMatrix(boxes: np.array, iouThresh: float) -> np.array:
+        ''' Takes an (N,4) array of x1,y1,x2,y2 boxes and returns an upper-triangular NxN boolean
+            matrix marking the pairs of boxes that overlap by more than iouThresh '''
+        topLeft = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+        bottomRight = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+        intersection = np.prod(np.clip(bottomRight - topLeft, 0, None), axis=2)
+        area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+        union = area[:, None] + area[None, :] - intersection
+        iou = intersection / np.maximum(union, np.finfo(np.float32).eps)
+        return np.triu(iou > iouThresh, k=1)
 
-                if self._debug:
+    @staticmethod
+    def _groupDuplicates(dups: np.array) -> tuple[int, list[int]]:
+        ''' Takes an NxN boolean matrix of duplicate pairs and returns the number of connected groups
+            along with the group index of each item. Groups are numbered in order of their first item '''
+        parents = list(range(len(dups)))
+
+        def findRoot(idx: int) -> int:
+            while parents[idx] != idx:
+                parents[idx] = parents[parents[idx]]
+                idx = parents[idx]
+            return idx
+
+        for idxA, idxB in zip(*np.nonzero(dups)):
+            rootA, rootB = findRoot(idxA), findRoot(idxB)
+            if rootA != rootB:
+                parents[max(rootA, rootB)] = min(rootA, rootB)
+
+        groupIds: dict[int, int] = {}
+        groups = [groupIds.setdefault(findRoot(idx), len(groupIds)) for idx in range(len(dups))]
+        return len(groupIds), groups
+
+    def _renderThreadProc(self, renderQueue: Queue):
+        ''' Draws overlays onto frames then publishes and/or displays them. A None item signals a stop '''
+        showWindow: bool = self._debug
+        if showWindow:
+            dbgWin = f"DebugWindow {self._source}"
+            try:
+                cv2.namedWindow(dbgWin, flags=cv2.WINDOW_NORMAL)
+            except Exception as e:
+                # Headless OpenCV builds have no GUI, images are still published without the window
+                logger.error(f"Failed to open debug window for {self._source}: {str(e)}")
+                showWindow = False
+
+        # Frames are drawn into a reused buffer rather than a fresh copy each frame. The source frame
+        # itself can't be drawn on as the object tracker may still be holding on to it
+        dbgImg: np.array = None
+        while True:
+            item = renderQueue.get()
+            if item is None:
+                break
+
+            img, overlays, dbgInfo, publish = item
+            try:
+                if dbgImg is None or dbgImg.shape != img.shape:
+                    dbgImg = np.empty_like(img)
+                np.copyto(dbgImg, img)
+                Watcher._drawOverlays(dbgImg, overlays)
+                cv2.putText(dbgImg, dbgInfo, (0, 32), LABEL_FONT, 0.4, (0, 0, 255), 1, cv2.LINE_AA)
+
+                if publish:
+                    # The BGR buffer is emitted as is. It is reused for the next frame, so slots must copy it to keep it
+                    self._imgUpdatedSignal.emit(image=dbgImg, userData=self._userData)
+
+                if showWindow:
                     cv2.imshow(dbgWin, dbgImg)
                     cv2.waitKey(1)
+            except Exception as e:
+                logger.error(f"Failed to render image for {self._source}: {str(e)}")
+
+    def _processLostObj(self, objTracker: ObjectTracker, key: int, trackedObj: WatchedObject) -> bool:
+        ''' Handles a tracked object that was lost this frame. Returns True if it was removed from objTracker '''
+        # If it was lost before reaching the minimum frame count then remove it
+        if trackedObj.age < NEW_OBJ_MIN_FRAME_CNT:
+            logger.debug(f"{trackedObj.label} lost before minimum frame count")
+            objTracker.removeBox(key)
+            return True
+
+        trackedObj.markMissing()
+        if trackedObj.framesSinceSeen > LOST_OBJ_REMOVE_FRAME_CNT:
+            logger.debug(f"{trackedObj.label} lost for {trackedObj.framesSinceSeen}, removing")
+            self._lostObjSignal.emit(obj=trackedObj, userData=self._userData)
+            objTracker.removeBox(key)
+            return True
+        return False
+
+    def _wantsStats(self) -> bool:
+        ''' Timing stats are only shown on rendered images, so they are only collected while images are rendered '''
+        return self._debug or len(self._imgUpdatedSignal.slots) > 0
 
-            logger.debug(f"---End of frame {frameCnt} [{self._source}]---")
-            frameCnt += 1
-
-        logger.info(f"!!!Exit frame capture loop for {self._source}!!!")
+    @staticmethod
+    def _putLatest(queue: Queue, item):
+        ''' Put item into a bounded queue, discarding the oldest items that were not yet consumed to make room '''
+        while True:
+            try:
+                queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    pass
 
     def saveTimelapse(self, img: np.array):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        timestamp = time.strftime("%Y-%m-%d_%H%M%S")
         output_path = os.path.join(self._timelapseDir, f"{timestamp}.png")
         logger.info(f"Saving timelapse {output_path}")
-        imgRgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        pilImg: Image = Image.fromarray(imgRgb)
-        pilImg.save(output_path)
+        # OpenCV writes BGR directly, and a low compression level keeps deflate from dominating the save
+        if not cv2.imwrite(output_path, img, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+            raise Exception(f"Failed to write {output_path}")
 
     @staticmethod
     def drawTrackerOnImage(img: np.array, tracker: BBoxTracker.Tracker, color: tuple[int, int, int] = (255, 255, 255)):
+        Watcher._drawOverlays(img, [Watcher._trackerOverlay(tracker, color=color)])
+
+    @staticmethod
+    def _trackerOverlay(tracker: BBoxTracker.Tracker, color: tuple[int, int, int] = (255, 255, 255)) -> Watcher._Overlay:
+        ''' Captures how a tracker should be drawn '''
         watchedObj: WatchedObject = tracker.metadata[METAKEY_TRACKED_WATCHED_OBJ]
 
         if watchedObj.age < NEW_OBJ_MIN_FRAME_CNT:
-            brightness = 255 * (1-(NEW_OBJ_MIN_FRAME_CNT - watchedObj.age)/NEW_OBJ_MIN_FRAME_CNT)
-            color = (0, brightness, 0)
+            color = NEW_OBJ_COLORS[watchedObj.age]
 
         if watchedObj.framesSinceSeen > 0:
-            red = 255 * (LOST_OBJ_REMOVE_FRAME_CNT - watchedObj.framesSinceSeen)/LOST_OBJ_REMOVE_FRAME_CNT
-            color = (0, 0, red)
+            color = LOST_OBJ_COLORS[min(watchedObj.framesSinceSeen, LOST_OBJ_REMOVE_FRAME_CNT)]
 
         label = f"{tracker.key} - {watchedObj.label} {watchedObj.conf:0.2}"
         if watchedObj.framesSinceSeen > 0:
             label += f" [missing {watchedObj.framesSinceSeen}|{watchedObj.age}]"
-        Watcher.drawBboxOnImage(img, tracker.bbox, color=color)
-        Watcher.drawBboxLabel(img, tracker.bbox, label, color=color)
-        for idx, (key, entry) in enumerate(watchedObj._confDict.items()):
-            Watcher.drawBboxLabel(img, tracker.bbox, f"{key}: {entry.tracker}", color=color, line=idx+1, size=0.3)
+        labels = [(label, 0.4)]
+        for key, entry in watchedObj._confDict.items():
+            labels.append((f"{key}: {entry.tracker}", 0.3))
+        return Watcher._Overlay(bbox=tracker.bbox.copy(), labels=labels, color=color)
+
+    @staticmethod
+    def _drawOverlays(img: np.array, overlays: list[Watcher._Overlay]):
+        ''' Draws all overlays onto img. Boxes sharing a style are drawn with a single polylines call,
+            then the labels are drawn on top '''
+        # Resolve pixel coordinates once for the rectangle and all of the labels
+        imgY, imgX = img.shape[:2]
+        coords = [overlay.bbox.asX1Y1X2Y2(imgX, imgY) for overlay in overlays]
+
+        rects: dict[tuple[tuple[int, int, int], int], list[np.array]] = {}
+        for overlay, (x1, y1, x2, y2) in zip(overlays, coords):
+            rects.setdefault((tuple(overlay.color), overlay.thickness), []).append(
+                np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], dtype=np.int32))
+        for (color, thickness), corners in rects.items():
+            cv2.polylines(img, corners, True, color, thickness=thickness)
+
+        for overlay, (x1, y1, x2, y2) in zip(overlays, coords):
+            for line, (label, size) in enumerate(overlay.labels):
+                Watcher._drawLabel(img, x1, y1, x2, y2, label, color=overlay.color, line=line, size=size, align=overlay.align)
 
     @staticmethod
     def drawBboxOnImage(img: np.array, bbox: BBox, color: tuple[int, int, int] = (255, 255, 255), thickness=1):
         imgY, imgX = img.shape[:2]
-        x1, y1, x2, y2 = bbox.asX1Y1X2Y2(imgX, imgY)
-        cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness=thickness)
+        Watcher._drawRect(img, *bbox.asX1Y1X2Y2(imgX, imgY), color=color, thickness=thickness)
 
     @staticmethod
     def drawBboxLabel(img: np.array,
@@ -329,11 +556,26 @@ class Watcher:
                       label: str,
                       color: tuple[int, int, int] = (255, 255, 255),
                       line: int = 0,
-                      font: int = cv2.FONT_HERSHEY_SIMPLEX,
+                      font: int = LABEL_FONT,
                       size: float = 0.4,
                       align: int = 0):
         imgY, imgX = img.shape[:2]
-        x1, y1, x2, y2 = bbox.asX1Y1X2Y2(imgX, imgY)
+        Watcher._drawLabel(img, *bbox.asX1Y1X2Y2(imgX, imgY), label,
+                           color=color, line=line, font=font, size=size, align=align)
+
+    @staticmethod
+    def _drawRect(img: np.array, x1: int, y1: int, x2: int, y2: int,
+                  color: tuple[int, int, int] = (255, 255, 255), thickness=1):
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness=thickness)
+
+    @staticmethod
+    def _drawLabel(img: np.array, x1: int, y1: int, x2: int, y2: int,
+                   label: str,
+                   color: tuple[int, int, int] = (255, 255, 255),
+                   line: int = 0,
+                   font: int = LABEL_FONT,
+                   size: float = 0.4,
+                   align: int = 0):
         if align == 7:
             yPos = y2 - line*16
         else:
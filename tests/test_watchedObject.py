@@ -0,0 +1,49 @@
+''' Tests for WatchedObject label selection '''
+import os
+import pathlib
+import sys
+
+# fmt: off
+rootDir = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(str(rootDir))
+sys.path.append(os.path.join(rootDir, "submodules"))
+from trackerTools.bbox import BBox
+from src.watchedObject import WatchedObject
+# fmt: on
+
+
+def _detection(label: str, conf: float) -> WatchedObject.Detection:
+    return WatchedObject.Detection(label=label, conf=conf, bbox=BBox((0.1, 0.1, 0.5, 0.5)))
+
+
+def test_bestLabelSingleDetection():
+    obj = WatchedObject(1, _detection("dog", 0.8))
+    assert obj.label == "dog"
+    assert obj.labelConf("dog") == 1.0
+    assert abs(obj.conf - 0.8) < 1e-9
+
+
+def test_bestLabelChangesWhenAnotherLabelOvertakes():
+    obj = WatchedObject(1, _detection("dog", 0.6))
+    obj.markSeen(_detection("cat", 0.9))
+    # Sums are dog 0.6, cat 0.9 out of 1.5
+    assert obj.label == "cat"
+    assert abs(obj.labelConf("cat") - 0.6) < 1e-9
+    assert abs(obj.labelConf("dog") - 0.4) < 1e-9
+    assert abs(obj.conf - 0.9 * 0.6) < 1e-9
+
+    obj.markSeen(_detection("dog", 0.7))
+    obj.markSeen(_detection("dog", 0.5))
+    # Sums are dog 1.8, cat 0.9 out of 2.7
+    assert obj.label == "dog"
+    assert abs(obj.labelConf("dog") - 1.8 / 2.7) < 1e-9
+    assert abs(obj.conf - 0.6 * (1.8 / 2.7)) < 1e-9
+
+
+def test_trackingOnlyFrameKeepsBestLabel():
+    obj = WatchedObject(1, _detection("dog", 0.6))
+    obj.markSeen(_detection("cat", 0.3), newFrame=False)
+    obj.markSeen()
+    assert obj.label == "dog"
+    assert abs(obj.labelConf("dog") - 2 / 3) < 1e-9
+    assert obj.age == 2
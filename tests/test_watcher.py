@@ -0,0 +1,60 @@
+''' Tests for Watcher's handling of lost objects '''
+import os
+import pathlib
+import sys
+
+# fmt: off
+rootDir = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(str(rootDir))
+sys.path.append(os.path.join(rootDir, "submodules"))
+from trackerTools.bbox import BBox
+from src.watchedObject import WatchedObject
+from src.watcher import Watcher, LOST_OBJ_REMOVE_FRAME_CNT, NEW_OBJ_MIN_FRAME_CNT
+# fmt: on
+
+
+class _FakeTracker:
+    def __init__(self):
+        self.removed: list[int] = []
+
+    def removeBox(self, key: int):
+        self.removed.append(key)
+
+
+def _watcher() -> tuple[Watcher, list[WatchedObject]]:
+    watcher = Watcher(source=None, server=None)
+    lost: list[WatchedObject] = []
+
+    def lostCallback(obj, **kwargs):
+        lost.append(obj)
+    watcher.connectLostObjSignal(lostCallback)
+    return watcher, lost
+
+
+def _watchedObject(age: int) -> WatchedObject:
+    obj = WatchedObject(objId=1, initialDetection=WatchedObject.Detection("dog", 0.9, BBox((0.1, 0.1, 0.5, 0.5))))
+    for _ in range(age - 1):
+        obj.markSeen()
+    return obj
+
+
+def test_youngLostObjectIsRemovedSilently():
+    watcher, lost = _watcher()
+    tracker = _FakeTracker()
+    assert watcher._processLostObj(tracker, 1, _watchedObject(NEW_OBJ_MIN_FRAME_CNT - 1))
+    assert tracker.removed == [1]
+    assert lost == []
+
+
+def test_lostObjectIsPublishedOnTheFrameItExpires():
+    watcher, lost = _watcher()
+    tracker = _FakeTracker()
+    obj = _watchedObject(NEW_OBJ_MIN_FRAME_CNT)
+    for _ in range(LOST_OBJ_REMOVE_FRAME_CNT):
+        assert not watcher._processLostObj(tracker, 1, obj)
+    assert obj.framesSinceSeen == LOST_OBJ_REMOVE_FRAME_CNT
+    assert lost == []
+
+    assert watcher._processLostObj(tracker, 1, obj)
+    assert tracker.removed == [1]
+    assert lost == [obj]
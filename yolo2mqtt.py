@@ -2,12 +2,13 @@ import sys
 import pathlib
 import os
 import logging
+import logging.handlers
 import yaml
 import argparse
-import io
+import cv2
 import multiprocessing as mp
+import multiprocessing.connection
 import numpy as np
-from PIL import Image
 from multiprocessing.queues import Queue
 from queue import Empty
 from dataclasses import dataclass
@@ -19,6 +20,7 @@ sys.path.append( scriptDir )
 sys.path.append(submodules_dir)
 from trackerTools.yoloInference import YoloInference
 from src.config import Config, Camera
+from src.inferenceServer import InferenceServer, InferenceClient
 from src.mqttClient import MqttClient
 from src.rtspSimpleServer import RtspSimpleServer
 from src.watchedObject import WatchedObject
@@ -29,6 +31,12 @@ from src.imgSources.urlSource import UrlSource
 from src.imgSources.videoSource import VideoSource
 # fmt: on
 
+# Use the libyaml parser when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger("Watcher")
 
@@ -38,6 +46,11 @@ KEY_ACTION_LOST = "lost"
 KEY_ACTION_UPDATED = "updated"
 KEY_ACTION_IMAGE_UPDATED = "image_updated"
 
+IMAGE_JPEG_QUALITY = 80  # Quality of JPEG images published to MQTT
+IMAGE_PNG_COMPRESSION = 1  # Compression level of PNG images published to MQTT
+MAX_PUBLISH_BATCH = 64  # Maximum number of queued worker messages handled together
+MAX_QUEUE_BACKLOG = 128  # Images are not queued for publishing while more than this many messages are waiting
+
 class Yolo2Mqtt:
     @dataclass
     class _WatcherUserData:
@@ -48,7 +61,8 @@ class Yolo2Mqtt:
             logging.getLogger().setLevel(logging.DEBUG)
 
         try:
-            config: dict = yaml.load(open(args.config), yaml.Loader)
+            with open(args.config) as configFile:
+                config: dict = yaml.load(configFile, YamlLoader)
         except Exception as e:
             logger.error(f"Failed to load config file {args.config}! {e}")
             config = {}
@@ -60,147 +74,314 @@ class Yolo2Mqtt:
         else:
             from multiprocessing.dummy import Process, Queue
 
+        # Hand log records off to a background listener so workers never block writing to stdout
+        self._logQueue: Queue = Queue()
+        self._logListener: logging.handlers.QueueListener = Yolo2Mqtt._startLogListener(self._logQueue)
+
         self._mqttDetTopic = self._config.Mqtt.detections
         self._mqttImageTopic = self._config.Mqtt.images
+        # Topics only depend on the camera (and object id), so build each camera's once
+        self._detTopicPrefixes: dict[str, str] = {name: f"{self._mqttDetTopic}/{name}/" for name in self._config.cameras}
+        self._imageTopics: dict[str, str] = {name: f"{self._mqttImageTopic}/{name}/image" for name in self._config.cameras}
 
         logger.info(f"Connecting to MQTT broker at {self._config.Mqtt.address}:{self._config.Mqtt.port}...")
 
         self._mqtt: MqttClient = MqttClient(broker_address=self._config.Mqtt.address,
                                             broker_port=self._config.Mqtt.port,
                                             prefix=self._config.Mqtt.prefix)
-        self._queue: Queue[tuple(str, WatchedObject)] = Queue()
+        self._queue: Queue[tuple[str, tuple]] = Queue()
+
+        # Threaded workers can share a single model per model config. Processes either load their own or,
+        # with shareModel, send their frames to a model served from this process
+        multiprocessing: bool = self._config.Yolo.multiprocessing
+        servers: dict[str, InferenceServer] = {}
+        if not multiprocessing or self._config.Yolo.shareModel:
+            for cameraInfo in self._config.cameras.values():
+                if cameraInfo.model in servers:
+                    continue
+                try:
+                    servers[cameraInfo.model] = Yolo2Mqtt._loadInferenceServer(self._config, cameraInfo.model)
+                except Exception as e:
+                    logger.error(f"Failed to create shared inference server: {e}")
+
+        clients: dict[str, InferenceClient] = {}
+        if multiprocessing:
+            for modelName, server in servers.items():
+                requestQueue: Queue = Queue()
+                replyQueues: dict[str, Queue] = {}
+                for key, cameraInfo in self._config.cameras.items():
+                    if cameraInfo.model == modelName:
+                        replyQueues[key] = Queue()
+                        clients[key] = InferenceClient(requestQueue, replyQueues[key], clientId=key,
+                                                       inputSize=self._config.models[modelName].width)
+                server.serveRemote(requestQueue, replyQueues)
+
+        # Connect to the RTSP proxy's API once. The client only holds the API address and the server's
+        # config, so workers can be handed a copy rather than each querying the server again
+        rtspApi: RtspSimpleServer = None
+        if any(cameraInfo.rtspUrl is not None for cameraInfo in self._config.cameras.values()):
+            try:
+                rtspApi = RtspSimpleServer(apiHost=self._config.RtspSimpleServer.apiHost,
+                                           apiPort=self._config.RtspSimpleServer.apiPort)
+            except Exception as e:
+                logger.warning(f"RtspSimpleServer unavailable, RTSP cameras will connect directly: {e}")
 
-        self._workers: list[Process] = []
+        self._workers: dict[str, Process] = {}
         for key, cameraInfo in self._config.cameras.items():
+            server = clients.get(key, None) if multiprocessing else servers.get(cameraInfo.model, None)
             newWorker = Process(target=Yolo2Mqtt._workerProc, args=(
-                key, self._queue, self._config, cameraInfo, args.debug))
-            self._workers.append(newWorker)
+                key, self._queue, self._config, cameraInfo, args.debug, server, rtspApi,
+                self._logQueue, logging.getLogger().level))
+            self._workers[key] = newWorker
 
-    def _objAddedCallback(self, obj, userData, **kwargs):
-        # SignalSlots doesn't support annotations
-        obj: WatchedObject = obj
-        userData: Yolo2Mqtt._WatcherUserData = userData
-        self._mqtt.publish(self._getDetTopic(obj, userData), obj.json(), retain=False)
+    def _objAddedCallback(self, objId: int, objJson: str, userData: _WatcherUserData):
+        self._mqtt.publish(self._getDetTopic(objId, userData), objJson, retain=False)
 
-    def _objRemovedCallback(self, obj, userData, **kwargs):
-        # SignalSlots doesn't support annotations
-        obj: WatchedObject = obj
-        userData: Yolo2Mqtt._WatcherUserData = userData
-        self._mqtt.publish(self._getDetTopic(obj, userData), None, retain=False)
+    def _objRemovedCallback(self, objId: int, userData: _WatcherUserData):
+        self._mqtt.publish(self._getDetTopic(objId, userData), None, retain=False)
 
-    def _objUpdatedCallback(self, obj, userData, **kwargs):
-        # SignalSlots doesn't support annotations
-        obj: WatchedObject = obj
-        userData: Yolo2Mqtt._WatcherUserData = userData
-        self._mqtt.publish(self._getDetTopic(obj, userData), obj.json(), retain=False)
+    def _objUpdatedCallback(self, objId: int, objJson: str, userData: _WatcherUserData):
+        self._mqtt.publish(self._getDetTopic(objId, userData), objJson, retain=False)
 
-    def _imgUpdatedCallback(self, image: Image, userData, **kwargs):
+    def _imgUpdatedCallback(self, image: bytes, userData, **kwargs):
         userData: Yolo2Mqtt._WatcherUserData = userData
-        output_buffer = io.BytesIO()
-        image.save(output_buffer, format="PNG")
-        self._mqtt.publish(self._getImageTopic(userData), output_buffer.getvalue(), retain=False)
+        self._mqtt.publish(self._getImageTopic(userData), image, retain=False)
+
+    @staticmethod
+    def _encodeImage(image: np.array, imageFormat: str = "jpg") -> bytes:
+        ''' Encodes a BGR image for publishing as jpg or png. JPEG encodes far faster than PNG and keeps the MQTT payload small '''
+        if imageFormat == "jpg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, IMAGE_JPEG_QUALITY]
+        elif imageFormat == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, IMAGE_PNG_COMPRESSION]
+        else:
+            raise Exception(f"Unsupported image format [{imageFormat}]")
+        ret, encoded = cv2.imencode(f".{imageFormat}", image, params)
+        if not ret:
+            raise Exception("Failed to encode image")
+        return encoded.tobytes()
+
+    @staticmethod
+    def _queueBacklog(queue: Queue) -> int:
+        ''' Approximate number of messages waiting in queue, or 0 where the platform can't tell '''
+        try:
+            return queue.qsize()
+        except NotImplementedError:
+            return 0
 
     def _getImageTopic(self, userData: _WatcherUserData ) -> str:
-        return f"{self._mqttImageTopic}/{userData.name}/image"
+        return self._imageTopics[userData.name]
 
-    def _getDetTopic(self, obj: WatchedObject, userData: _WatcherUserData) -> str:
-        return f"{self._mqttDetTopic}/{userData.name}/{obj.objId}"
+    def _getDetTopic(self, objId: int, userData: _WatcherUserData) -> str:
+        return self._detTopicPrefixes[userData.name] + str(objId)
 
     @staticmethod
     def _getSource(name: str, cameraConfig: Camera, rtspApi: RtspSimpleServer = None) -> Source:
         ''' Returns a source for the given camera config'''
         if cameraConfig.rtspUrl is not None:
-            return RtspSource(name=name, rtspUrl=cameraConfig.rtspUrl, rtspApi=rtspApi)
+            return RtspSource(name=name, rtspUrl=cameraConfig.rtspUrl, rtspApi=rtspApi, hwDecode=cameraConfig.hwDecode)
 
         if cameraConfig.videoPath is not None:
-            return VideoSource(cameraConfig.videoPath)
+            return VideoSource(cameraConfig.videoPath, hwDecode=cameraConfig.hwDecode)
 
         if cameraConfig.imageUrl is not None:
             return UrlSource(cameraConfig.imageUrl, user=cameraConfig.username, password=cameraConfig.password)
 
         return None
 
+    @staticmethod
+    def _loadInferenceServer(config: Config, modelName: str) -> InferenceServer:
+        ''' Loads the named model and returns an InferenceServer running it. Raises on failure '''
+        modelInfo = config.models.get(modelName, None)
+        if modelInfo is None:
+            raise Exception(f"Could not find model configuration [{modelName}]")
+
+        try:
+            model = YoloInference(weights=modelInfo.path, imgSize=modelInfo.width,
+                                  labels=modelInfo.labels, device=config.Yolo.device,
+                                  yoloVersion=modelInfo.yoloVersion)
+        except Exception as e:
+            raise Exception(f"Failed to load model [{modelInfo.path}]: {e}")
+        return InferenceServer(model, inputSize=modelInfo.width, amp=config.Yolo.amp, device=config.Yolo.device)
+
+    @staticmethod
+    def _startLogListener(logQueue: Queue) -> logging.handlers.QueueListener:
+        ''' Moves the root logger's handlers onto a listener thread fed by logQueue '''
+        rootLogger = logging.getLogger()
+        handlers = rootLogger.handlers[:]
+        for handler in handlers:
+            rootLogger.removeHandler(handler)
+        rootLogger.addHandler(logging.handlers.QueueHandler(logQueue))
+        listener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+        listener.start()
+        return listener
+
+    @staticmethod
+    def _configureWorkerLogging(logQueue: Queue, logLevel: int):
+        ''' Sends a worker process's log records to the main process's listener at the main process's level '''
+        rootLogger = logging.getLogger()
+        for handler in rootLogger.handlers[:]:
+            rootLogger.removeHandler(handler)
+        rootLogger.addHandler(logging.handlers.QueueHandler(logQueue))
+        rootLogger.setLevel(logLevel)
+
     def run(self):
         logger.info("Starting workers...")
-        for worker in self._workers:
+        for worker in self._workers.values():
             worker.start()
 
-        while True:
+        try:
+            while True:
+                data: tuple[str, tuple] = self._getNext()
+                if data is None:
+                    # Check if workers are running
+                    for name in [name for name, worker in self._workers.items() if not worker.is_alive()]:
+                        logger.warning(f"Worker for camera {name} has exited.")
+                        self._workers.pop(name).join(timeout=0)
+
+                if data:
+                    for action, action_data in self._getBatch(data):
+                        if action == KEY_ACTION_ADDED:
+                            objId, objJson, userdata = action_data
+                            self._objAddedCallback(objId, objJson, userdata)
+                        elif action == KEY_ACTION_LOST:
+                            objId, _, userdata = action_data
+                            self._objRemovedCallback(objId, userdata)
+                        elif action == KEY_ACTION_UPDATED:
+                            objId, objJson, userdata = action_data
+                            self._objUpdatedCallback(objId, objJson, userdata)
+                        elif action == KEY_ACTION_IMAGE_UPDATED:
+                            img, userdata = action_data
+                            self._imgUpdatedCallback(img, userdata)
+                        else:
+                            logger.warning(f"Unknown action: [{action}]")
+                if len(self._workers) == 0:
+                    logger.info("All workers have exited")
+                    break
+        finally:
+            # Flush whatever workers logged before an error or interrupt ended the loop
+            self._logListener.stop()
+
+    def _getNext(self) -> tuple[str, tuple]:
+        ''' Waits for the next item from the workers. Returns None if there was none, eg because a worker exited '''
+        if self._config.Yolo.multiprocessing:
+            # Sleep until data is queued or a worker process exits, rather than polling
+            mp.connection.wait([self._queue._reader] + [worker.sentinel for worker in self._workers.values()])
+            try:
+                return self._queue.get_nowait()
+            except Empty:
+                return None
+
+        # Worker threads have no sentinel to wait on, so poll for them exiting
+        try:
+            return self._queue.get(timeout=1)
+        except Empty:
+            return None
+
+    def _getBatch(self, first: tuple[str, tuple]) -> list[tuple[str, tuple]]:
+        ''' Collects anything else already queued behind first, up to MAX_PUBLISH_BATCH items, and
+            coalesces them so that only the latest state of each object and image is published '''
+        batch = [first]
+        while len(batch) < MAX_PUBLISH_BATCH:
             try:
-                data: tuple[str, WatchedObject] = self._queue.get(timeout=1)
-            except Empty as e:
-                data = None
-                # Check if workers are running
-                lostProcIdxs = [idx for idx, worker in enumerate(reversed(self._workers)) if not worker.is_alive()]
-                for idx in lostProcIdxs:
-                    proc = self._workers[idx]
-                    logger.warning(f"Worker {idx}:{proc.name} has exited.")
-                    del self._workers[idx]
-
-            if data:
-                action, action_data = data
-                if action == KEY_ACTION_ADDED:
-                    obj, userdata = action_data
-                    self._objAddedCallback(obj, userdata)
-                elif action == KEY_ACTION_LOST:
-                    obj, userdata = action_data
-                    self._objRemovedCallback(obj, userdata)
-                elif action == KEY_ACTION_UPDATED:
-                    obj, userdata = action_data
-                    self._objUpdatedCallback(obj, userdata)
-                elif action == KEY_ACTION_IMAGE_UPDATED:
-                    img, userdata = action_data
-                    self._imgUpdatedCallback(img, userdata)
-                else:
-                    logger.warning(f"Unknown action: [{action}]")
-            if len(self._workers) == 0:
-                logger.info("All workers have exited")
+                batch.append(self._queue.get_nowait())
+            except Empty:
                 break
+        return Yolo2Mqtt._coalesce(batch)
 
     @staticmethod
-    def _workerProc(name: str, queue: Queue, config: Config, camera: Camera, debug: bool = False) -> None:
-        print(f"Background thread {name}")
+    def _coalesce(batch: list[tuple[str, tuple]]) -> list[tuple[str, tuple]]:
+        ''' Drops object updates and images that are superseded by a later one in the same batch.
+            Added and lost events are always kept, and an update is never dropped across one '''
+        superseded: set[tuple[str, int]] = set()
+        kept = []
+        for action, action_data in reversed(batch):
+            if action in (KEY_ACTION_ADDED, KEY_ACTION_LOST, KEY_ACTION_UPDATED):
+                objId, _, userdata = action_data
+                key = (userdata.name, objId)
+            elif action == KEY_ACTION_IMAGE_UPDATED:
+                key = (action_data[1].name, None)
+            else:
+                kept.append((action, action_data))
+                continue
+
+            if action in (KEY_ACTION_UPDATED, KEY_ACTION_IMAGE_UPDATED):
+                if key in superseded:
+                    continue
+                superseded.add(key)
+            else:
+                superseded.discard(key)
+            kept.append((action, action_data))
+        kept.reverse()
+        return kept
+
+    @staticmethod
+    def _workerProc(name: str, queue: Queue, config: Config, camera: Camera, debug: bool = False,
+                    server: "InferenceServer | InferenceClient" = None, rtspApi: RtspSimpleServer = None,
+                    logQueue: Queue = None, logLevel: int = logging.NOTSET) -> None:
+        # Worker processes are started from the forkserver, so they don't inherit this process's logging setup
+        if config.Yolo.multiprocessing and logQueue is not None:
+            Yolo2Mqtt._configureWorkerLogging(logQueue, logLevel)
+
         logger = logging.getLogger(f"Worker_{name}")
+        logger.info(f"Background thread {name}")
+
+        # Cameras already run in parallel, so OpenCV spreading each call over every core only oversubscribes them
+        if config.Yolo.multiprocessing or len(config.cameras) > 1:
+            cv2.setNumThreads(1)
+
+        # Keep each worker process on its own core so its caches stay warm
+        if config.Yolo.pinWorkers and config.Yolo.multiprocessing and hasattr(os, "sched_setaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            cpu = cpus[list(config.cameras).index(name) % len(cpus)]
+            try:
+                os.sched_setaffinity(0, {cpu})
+                logger.info(f"Pinned worker {name} to CPU {cpu}")
+            except OSError as e:
+                logger.warning(f"Failed to pin worker {name} to CPU {cpu}: {e}")
 
         def fatal(msg: str):
             logger.error(msg)
             raise Exception(msg)
 
-        try:
-            rtspApi = RtspSimpleServer(apiHost=config.RtspSimpleServer.apiHost,
-                                       apiPort=config.RtspSimpleServer.apiPort)
-        except Exception as e:
-            rtspApi = None
-
-        modelInfo = config.models.get(camera.model, None)
-        if modelInfo is None:
-            fatal(f"Could not find model configuration [{camera.model}]")
-
-        try:
-            model = YoloInference(weights=modelInfo.path, imgSize=modelInfo.width,
-                                  labels=modelInfo.labels, device=config.Yolo.device,
-                                  yoloVersion=modelInfo.yoloVersion)
-        except Exception as e:
-            fatal(f"Failed to load model [{modelInfo.path}]: {e}")
+        if server is None:
+            try:
+                server = Yolo2Mqtt._loadInferenceServer(config, camera.model)
+            except Exception as e:
+                fatal(str(e))
 
         source = Yolo2Mqtt._getSource(name=name, cameraConfig=camera, rtspApi=rtspApi)
         if source is None:
             fatal(f"Could not load configured source")
 
+        # Objects are sent to the main process as their id and already serialized json rather than pickled whole.
+        # This is far less to pickle, and the queue's feeder thread no longer pickles an object the Watcher may be updating
         def objAddedCallback(obj, userData, **kwargs):
-            queue.put((KEY_ACTION_ADDED, (obj, userData)))
+            obj: WatchedObject = obj
+            queue.put((KEY_ACTION_ADDED, (obj.objId, obj.json(), userData)))
 
         def objLostCallback(obj, userData, **kwargs):
-            queue.put((KEY_ACTION_LOST, (obj, userData)))
+            obj: WatchedObject = obj
+            queue.put((KEY_ACTION_LOST, (obj.objId, None, userData)))
 
         def objUpdatedCallback(obj, userData, **kwargs):
-            queue.put((KEY_ACTION_UPDATED, (obj, userData)))
+            obj: WatchedObject = obj
+            queue.put((KEY_ACTION_UPDATED, (obj.objId, obj.json(), userData)))
 
         def imageUpdatedCallback(image, userData,  **kwargs):
-            queue.put((KEY_ACTION_IMAGE_UPDATED, (image, userData)))
+            # Images are only a preview, so while the main process is behind they are skipped rather than queued.
+            # Object events are always queued
+            if Yolo2Mqtt._queueBacklog(queue) > MAX_QUEUE_BACKLOG:
+                logger.debug("Publish queue is backed up, skipping image")
+                return
+            # Encode here so only the compressed image, rather than the raw frame, is sent to the main process
+            try:
+                queue.put((KEY_ACTION_IMAGE_UPDATED, (Yolo2Mqtt._encodeImage(image, config.Mqtt.imageFormat), userData)))
+            except Exception as e:
+                logger.error(f"Failed to publish image: {e}")
 
 
-        watcher: Watcher = Watcher(source=source, model=model, refreshDelay=camera.refresh,
+        watcher: Watcher = Watcher(source=source, server=server, refreshDelay=camera.refresh,
                                    userData=Yolo2Mqtt._WatcherUserData(name), timelapseDir=camera.timelapseDir,
                                    timelapseInterval=camera.timelapseInterval, debug=debug)
         watcher.connectNewObjSignal(objAddedCallback)
@@ -226,6 +407,11 @@ def parseArgs():
 # program entry point
 #
 if __name__ == "__main__":
+    # Workers fork from a server that has already imported this module (and so torch, cv2, trackerTools),
+    # rather than each re-importing everything as they would with spawn
+    if "forkserver" in mp.get_all_start_methods():
+        mp.set_start_method("forkserver", force=True)
+        mp.set_forkserver_preload(["__main__"])
     args = parseArgs()
     Yolo2Mqtt = Yolo2Mqtt(args)
     Yolo2Mqtt.run()